@@ -4,20 +4,29 @@
 # - Auto-approves join requests only for users who paid (c_orders)
 # - PhonePe Business parsing; unique amount locks; configurable unpaid-QR cleanup
 # - Safety patch: delivery messages wrapped to avoid crashes if user hasn’t opened DM
-
-import os, logging, time, random, re, unicodedata
+# - Multi-payee UPI pool; amount locks are per (payee, amount) so each payee adds a full set of slots
+# - Payment log kept small: daily rollups, old entries moved to compressed per-day archive docs
+# - /stats served from one incrementally-updated counters doc (estimated counts as fallback)
+# - Album uploads are buffered per admin and stored with bulk forwardMessages + one summary reply
+# - Reconciler: unmatched payments joined against live + recently expired sessions from a checkpoint
+# - Priority lanes: payments/join-requests, user traffic and admin bulk jobs run on separate worker pools
+# - All Bot API calls share one pooled client: global + per-chat token buckets, RetryAfter backoff, read coalescing
+
+import os, logging, time, random, re, unicodedata, json, zlib, threading, queue
+from collections import deque
 from datetime import datetime, timedelta
 from urllib.parse import quote
 
 from telegram import Update, ParseMode, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     Updater, CommandHandler, MessageHandler, Filters, CallbackContext,
-    ConversationHandler, CallbackQueryHandler, ChatJoinRequestHandler
+    ConversationHandler, CallbackQueryHandler, ChatJoinRequestHandler, ExtBot
 )
-from telegram.error import BadRequest, Unauthorized
+from telegram.error import BadRequest, Unauthorized, RetryAfter
+from telegram.utils.request import Request
 
 from pymongo import MongoClient, ASCENDING
-from pymongo.errors import DuplicateKeyError
+from pymongo.errors import DuplicateKeyError, OperationFailure
 
 logging.basicConfig(format="%(asctime)s %(levelname)s:%(name)s: %(message)s", level=logging.INFO)
 log = logging.getLogger("upi-mongo-bot")
@@ -34,10 +43,52 @@ PAYMENT_NOTIF_CHANNEL_ID = -1002865174188
 UPI_ID = "q57609025@ybl"
 UPI_PAYEE_NAME = "Seller"
 
+# Payee pool. Each payee needs its own PhonePe Business notification channel;
+# a payment posted in that channel only matches sessions issued for that payee.
+UPI_PAYEES = [
+    {"upi_id": UPI_ID, "name": UPI_PAYEE_NAME, "notif_channel_id": PAYMENT_NOTIF_CHANNEL_ID},
+    # {"upi_id": "second@ybl", "name": "Seller", "notif_channel_id": -100XXXXXXXXXX},
+]
+PAYEE_BY_CHANNEL = {int(p["notif_channel_id"]): p for p in UPI_PAYEES}
+PAYMENT_NOTIF_CHANNEL_IDS = list(PAYEE_BY_CHANNEL)
+
 PAY_WINDOW_MINUTES = 5
+# Fixed-price products charge the exact price; only when this is on may a busy product quote
+# price + ₹0.01–0.99 (stated in the QR caption) instead of refusing once every payee holds the price.
+FIXED_PRICE_PAISE_OFFSETS = False
 GRACE_SECONDS = 10
 DELETE_AFTER_MINUTES = 10
 
+ALBUM_FLUSH_SECONDS = 2       # quiet time after the last album part before storing the batch
+
+# Worker threads per lane. "pay" is reserved for payment posts + join requests so
+# /start floods ("user") and broadcasts ("bulk") can never occupy its workers.
+# "admin" stores uploaded product/broadcast files; one worker keeps them in upload order.
+LANE_WORKERS = {"pay": 4, "user": 4, "bulk": 1, "admin": 1}
+LANE_DRAIN_SECONDS = 60   # on shutdown, wait this long per lane for queued work to finish
+
+# Outbound Bot API limits (Telegram: ~30 msg/s overall, ~1/s per private chat, 20/min per group/channel)
+API_GLOBAL_RATE, API_GLOBAL_BURST = 28.0, 30
+API_PRIVATE_RATE, API_PRIVATE_BURST = 1.0, 20
+API_GROUP_RATE, API_GROUP_BURST = 20 / 60.0, 20
+API_BULK_RESERVE = 8        # global tokens the "bulk"/"admin" lanes must leave for payments/users
+API_MAX_RETRIES = 3
+API_POOL_SIZE = sum(LANE_WORKERS.values()) + 16   # keep-alive connections (lanes + jobs + dispatcher + polling)
+
+SESSION_SWEEP_SECONDS = 15          # expiry sweep period; it is the only path that expires sessions
+SESSION_TTL_BACKSTOP_MINUTES = 24 * 60  # Mongo TTL only drops sessions the sweep never got to (bot down > 24h,
+                                        # by which point Telegram has discarded the pending payment posts too)
+
+RECONCILE_INTERVAL_SECONDS = 60
+RECONCILE_SETTLE_SECONDS = 30      # leave fresh notifications to on_channel_post
+RECONCILE_TOLERANCE_MINUTES = 10   # payment may land this far outside created_at..hard_expire_at
+RECONCILE_KEEP_HOURS = 24          # how long expired sessions stay matchable
+
+PAYLOG_HOT_DAYS = 3            # raw notifications older than this move to the archive
+PAYLOG_ARCHIVE_BATCH = 2000    # docs per archive batch
+PAYLOG_ARCHIVE_BUDGET_SECONDS = 300  # a run keeps archiving batches until caught up or out of time
+PAYLOG_EXPORT_DIR = os.getenv("PAYLOG_EXPORT_DIR")  # optional: also append archived rows as local JSONL
+
 PROTECT_CONTENT_ENABLED = False
 FORCE_SUBSCRIBE_ENABLED = True
 FORCE_SUBSCRIBE_CHANNEL_IDS = []
@@ -56,16 +107,250 @@ c_locks    = mdb["locks"]
 c_paylog   = mdb["payments"]
 c_orders   = mdb["orders"]
 c_sales    = mdb["sales"]
+c_payarch  = mdb["payments_archive"]
+c_paystats = mdb["payment_stats"]
+c_counters = mdb["counters"]
+c_expired  = mdb["sessions_expired"]
 
 c_users.create_index([("user_id", ASCENDING)], unique=True)
 c_products.create_index([("item_id", ASCENDING)], unique=True)
 c_config.create_index([("key", ASCENDING)], unique=True)
 c_sessions.create_index([("key", ASCENDING)], unique=True)
 c_sessions.create_index([("amount_key", ASCENDING)])
-c_sessions.create_index([("hard_expire_at", ASCENDING)], expireAfterSeconds=0)
+c_sessions.create_index([("payee", ASCENDING), ("amount_key", ASCENDING)])
+c_sessions.create_index([("user_id", ASCENDING), ("item_id", ASCENDING)])
+def ensure_ttl(coll, field: str, seconds: int):
+    # create_index can't change expireAfterSeconds on an existing index; collMod can
+    try:
+        coll.create_index([(field, ASCENDING)], expireAfterSeconds=seconds)
+    except OperationFailure:
+        mdb.command("collMod", coll.name, index={"keyPattern": {field: 1}, "expireAfterSeconds": seconds})
+
+ensure_ttl(c_sessions, "hard_expire_at", SESSION_TTL_BACKSTOP_MINUTES * 60)
+c_locks.create_index([("payee", ASCENDING), ("amount_key", ASCENDING)], unique=True,
+                     partialFilterExpression={"payee": {"$type": "string"}})
+c_locks.create_index([("hard_expire_at", ASCENDING)], expireAfterSeconds=0)
 c_paylog.create_index([("ts", ASCENDING)])
+c_paylog.create_index([("matched", ASCENDING), ("inserted_at", ASCENDING)])
+c_expired.create_index([("payee", ASCENDING), ("amount_key", ASCENDING), ("hard_expire_at", ASCENDING)])
+c_expired.create_index([("expired_at", ASCENDING)], expireAfterSeconds=RECONCILE_KEEP_HOURS * 3600)
 c_orders.create_index([("user_id", ASCENDING), ("channel_id", ASCENDING)], unique=True)
 c_sales.create_index([("admin_id", ASCENDING), ("ts", ASCENDING)])
+c_payarch.create_index([("day", ASCENDING)])
+c_payarch.create_index([("day", ASCENDING), ("first_id", ASCENDING)], unique=True)
+c_paystats.create_index([("day", ASCENDING)], unique=True)
+
+# ---- Priority lanes: one queue + dedicated workers per class of update ----
+_lane_local = threading.local()  # .name = lane of the current worker thread (None on dispatcher/job threads)
+
+class Lane:
+    def __init__(self, name: str, workers: int):
+        self.name = name
+        self.workers = workers
+        self.q = queue.Queue()
+        self.lock = threading.Lock()
+        self.waits = deque(maxlen=500)
+        self.busy = 0
+        self.done = 0
+        self.max_wait = 0.0
+        for i in range(workers):
+            threading.Thread(target=self._run, name=f"lane-{name}-{i}", daemon=True).start()
+
+    def submit(self, fn, *a, **k):
+        self.q.put((time.monotonic(), fn, a, k))
+
+    def _run(self):
+        _lane_local.name = self.name
+        while True:
+            t0, fn, a, k = self.q.get()
+            wait = time.monotonic() - t0
+            with self.lock:
+                self.waits.append(wait); self.busy += 1
+                self.max_wait = max(self.max_wait, wait)
+            try:
+                fn(*a, **k)
+            except Exception as e:
+                log.exception(f"[lane {self.name}] {getattr(fn, '__name__', fn)} failed: {e}")
+            finally:
+                with self.lock:
+                    self.busy -= 1; self.done += 1
+                self.q.task_done()
+
+    def drain(self, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        while self.q.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.2)
+        return not self.q.unfinished_tasks
+
+    def stats(self) -> str:
+        with self.lock:
+            w = sorted(self.waits); busy, done, mx = self.busy, self.done, self.max_wait
+        avg = (sum(w) / len(w) * 1000) if w else 0.0
+        p95 = (w[min(len(w) - 1, int(len(w) * 0.95))] * 1000) if w else 0.0
+        return (f"{self.name}: queued {self.q.qsize()}, busy {busy}/{self.workers}, done {done}, "
+                f"wait avg {avg:.0f}ms p95 {p95:.0f}ms max {mx * 1000:.0f}ms")
+
+LANES = {}
+
+def start_lanes():
+    for name, n in LANE_WORKERS.items():
+        LANES[name] = Lane(name, n)
+
+def stop_lanes():
+    # workers are daemon threads: without this, queued updates whose offset was already confirmed are lost
+    for lane in LANES.values():
+        if not lane.drain(LANE_DRAIN_SECONDS):
+            log.warning(f"[lane {lane.name}] shutdown with {lane.q.unfinished_tasks} unfinished tasks")
+
+def in_lane(name: str):
+    """Run the handler on a lane's workers; the dispatcher thread only enqueues."""
+    def deco(fn):
+        def wrapper(update, context, *a, **k):
+            lane = LANES.get(name)
+            if lane is None: return fn(update, context, *a, **k)
+            lane.submit(fn, update, context, *a, **k)
+        wrapper.__name__ = fn.__name__
+        return wrapper
+    return deco
+
+# ---- Outbound client: every Bot API call goes through OutboundBot._post ----
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate, self.cap = rate, float(burst)
+        self.tokens, self.t = float(burst), time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, reserve: float = 0.0, block: bool = True) -> float:
+        """
+        Take one token, keeping `reserve` tokens untouched; returns seconds spent waiting.
+        With block=False nothing is taken and the needed wait is returned negated.
+        """
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.cap, self.tokens + (now - self.t) * self.rate); self.t = now
+                if self.tokens - 1 >= reserve:
+                    self.tokens -= 1
+                    return waited
+                need = (1 + reserve - self.tokens) / self.rate
+            if not block: return -need
+            time.sleep(need); waited += need
+
+    def pause(self, seconds: float):
+        with self.lock:
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+# methods that put a message into a chat and so count against its per-chat limit
+API_SEND_METHODS = {
+    "sendMessage", "sendPhoto", "sendVideo", "sendDocument", "sendAnimation", "sendAudio", "sendVoice",
+    "sendMediaGroup", "copyMessage", "copyMessages", "forwardMessage", "forwardMessages",
+}
+# read-only calls: identical concurrent calls share one request; value = seconds to cache the result
+API_COALESCE_METHODS = {"getChat": 60.0, "getChatMember": 0.0}
+
+class OutboundBot(ExtBot):
+    def __init__(self, *a, **k):
+        super().__init__(*a, **k)
+        self._global = TokenBucket(API_GLOBAL_RATE, API_GLOBAL_BURST)
+        self._chats = {}
+        self._inflight = {}
+        self._cache = {}
+        self._mlock = threading.Lock()
+        self.metrics = {}
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        with self._mlock:
+            b = self._chats.get(chat_id)
+            if b is None:
+                if len(self._chats) > 5000:  # broadcasts touch every user; forget idle (full) buckets
+                    now = time.monotonic()
+                    self._chats = {c: x for c, x in self._chats.items()
+                                   if x.tokens + (now - x.t) * x.rate < x.cap}
+                private = isinstance(chat_id, int) and chat_id > 0
+                b = self._chats[chat_id] = (TokenBucket(API_PRIVATE_RATE, API_PRIVATE_BURST) if private
+                                            else TokenBucket(API_GROUP_RATE, API_GROUP_BURST))
+            return b
+
+    def _metric_row(self, endpoint: str) -> dict:  # caller holds _mlock
+        return self.metrics.setdefault(endpoint, {"calls": 0, "errors": 0, "retry_after": 0, "shed": 0,
+                                                  "coalesced": 0, "latency": 0.0, "throttled": 0.0})
+
+    def _metric(self, endpoint: str, **inc):
+        with self._mlock:
+            m = self._metric_row(endpoint)
+            for k, v in inc.items(): m[k] += v
+
+    def _post(self, endpoint, data=None, *a, **k):
+        if endpoint == "getUpdates":
+            return super()._post(endpoint, data, *a, **k)
+        ttl = API_COALESCE_METHODS.get(endpoint)
+        if ttl is None:
+            return self._limited_post(endpoint, data, *a, **k)
+        key = (endpoint, json.dumps(data or {}, sort_keys=True, default=str))
+        with self._mlock:
+            hit = self._cache.get(key)
+            if hit and hit[0] > time.monotonic():
+                self._metric_row(endpoint)["coalesced"] += 1
+                return hit[1]
+            slot = self._inflight.get(key)
+            leader = slot is None
+            if leader:
+                slot = self._inflight[key] = {"ev": threading.Event(), "res": None, "err": None}
+        if not leader and threading.current_thread().name.endswith(":dispatcher"):
+            return self._limited_post(endpoint, data, *a, **k)  # don't park the dispatcher behind a throttled leader
+        if not leader:
+            slot["ev"].wait()
+            self._metric(endpoint, coalesced=1)
+            if slot["err"]: raise slot["err"]
+            return slot["res"]
+        try:
+            slot["res"] = self._limited_post(endpoint, data, *a, **k)
+            if ttl:
+                with self._mlock: self._cache[key] = (time.monotonic() + ttl, slot["res"])
+            return slot["res"]
+        except Exception as e:
+            slot["err"] = e
+            raise
+        finally:
+            with self._mlock: self._inflight.pop(key, None)
+            slot["ev"].set()
+
+    def _limited_post(self, endpoint, data, *a, **k):
+        chat_id = (data or {}).get("chat_id") if endpoint in API_SEND_METHODS else None
+        reserve = API_BULK_RESERVE if getattr(_lane_local, "name", None) in ("bulk", "admin") else 0
+        # the dispatcher thread also logs payment posts, so it never sleeps here: over the limit it fails fast
+        block = not threading.current_thread().name.endswith(":dispatcher")
+        for attempt in range(API_MAX_RETRIES + 1):
+            waited = self._global.acquire(reserve, block)
+            if waited >= 0 and chat_id is not None:
+                waited += self._chat_bucket(chat_id).acquire(block=block)
+            if waited < 0:
+                self._metric(endpoint, shed=1)
+                raise RetryAfter(max(1, int(-waited + 0.999)))
+            t0 = time.monotonic()
+            try:
+                res = super()._post(endpoint, data, *a, **k)
+                self._metric(endpoint, calls=1, latency=time.monotonic() - t0, throttled=waited)
+                return res
+            except RetryAfter as e:
+                self._metric(endpoint, calls=1, retry_after=1, latency=time.monotonic() - t0, throttled=waited)
+                (self._chat_bucket(chat_id) if chat_id is not None else self._global).pause(e.retry_after)
+                if attempt == API_MAX_RETRIES or not block: raise
+                log.warning(f"{endpoint}: flood control, retry in {e.retry_after}s")
+            except Exception:
+                self._metric(endpoint, calls=1, errors=1, latency=time.monotonic() - t0, throttled=waited)
+                raise
+
+    def metrics_text(self) -> str:
+        with self._mlock:
+            rows = sorted(self.metrics.items(), key=lambda kv: kv[1]["calls"], reverse=True)
+        out = []
+        for ep, m in rows:
+            avg = m["latency"] / m["calls"] * 1000 if m["calls"] else 0.0
+            out.append(f"{ep}: {m['calls']} calls, {m['errors']} err, {m['retry_after']} 429, {m['shed']} shed, "
+                       f"{m['coalesced']} coalesced, avg {avg:.0f}ms, throttled {m['throttled']:.1f}s")
+        return "\n".join(out) or "No API calls yet."
 
 def cfg(key, default=None):
     doc = c_config.find_one({"key": key})
@@ -105,6 +390,9 @@ def ist_today_bounds_utc():
     end_utc = start_utc + timedelta(days=1)
     return start_utc, end_utc
 
+def ist_day(ts: datetime) -> str:
+    return (ts + timedelta(hours=5, minutes=30)).strftime("%Y-%m-%d")
+
 def parse_start_payload(payload: str):
     try:
         if "__admin_" in payload:
@@ -117,34 +405,68 @@ def parse_start_payload(payload: str):
 def amount_key(x: float) -> str:
     return f"{x:.2f}" if abs(x - int(x)) > 1e-9 else str(int(x))
 
-def build_upi_uri(amount: float, note: str):
+def build_upi_uri(amount: float, note: str, payee: dict = None):
+    payee = payee or UPI_PAYEES[0]
     amt = f"{int(amount)}" if abs(amount-int(amount))<1e-9 else f"{amount:.2f}"
-    pa = quote(UPI_ID, safe=''); pn = quote(UPI_PAYEE_NAME, safe=''); tn = quote(note, safe='')
+    pa = quote(payee["upi_id"], safe=''); pn = quote(payee["name"], safe=''); tn = quote(note, safe='')
     return f"upi://pay?pa={pa}&pn={pn}&am={amt}&cu=INR&tn={tn}"
 
 def qr_url(data: str):
     return f"https://api.qrserver.com/v1/create-qr-code/?data={quote(data, safe='')}&size=512x512&qzone=2"
 
-def add_user(uid, uname): c_users.update_one({"user_id": uid},{"$set":{"username":uname or ""}},upsert=True)
+# ---- Counters: one doc, $inc'd on the hot paths so /stats never scans ----
+COUNTERS_ID = "global"
+
+def bump(fields: dict):
+    try: c_counters.update_one({"_id": COUNTERS_ID}, {"$inc": fields}, upsert=True)
+    except Exception as e: log.error(f"Counter update failed: {e}")
+
+def seed_counters():
+    # first run: start from estimates; every start: resync active sessions (jobs are lost on restart)
+    if not c_counters.find_one({"_id": COUNTERS_ID}, {"_id": 1}):
+        c_counters.update_one({"_id": COUNTERS_ID},
+                              {"$setOnInsert": {"users": c_users.estimated_document_count()}}, upsert=True)
+    c_counters.update_one({"_id": COUNTERS_ID}, {"$set": {"active_sessions": c_sessions.count_documents({})}})
+
+def add_user(uid, uname):
+    res = c_users.update_one({"user_id": uid},{"$set":{"username":uname or ""}},upsert=True)
+    if res.upserted_id is not None: bump({"users": 1})
 def get_all_user_ids(): return list(c_users.distinct("user_id"))
 
-def reserve_amount_key(k: str, hard_expire_at: datetime) -> bool:
+def reserve_amount_key(payee: str, k: str, hard_expire_at: datetime) -> bool:
     try:
-        c_locks.insert_one({"amount_key": k,"hard_expire_at": hard_expire_at,"created_at": datetime.utcnow()})
+        c_locks.insert_one({"payee": payee,"amount_key": k,"hard_expire_at": hard_expire_at,"created_at": datetime.utcnow()})
         return True
     except DuplicateKeyError:
         return False
-def release_amount_key(k: str): c_locks.delete_one({"amount_key": k})
-
-def pick_unique_amount(lo: float, hi: float, hard_expire_at: datetime) -> float:
+def release_amount_key(payee: str, k: str): c_locks.delete_one({"payee": payee, "amount_key": k})
+
+def _shuffled_payees():
+    payees = UPI_PAYEES[:]; random.shuffle(payees)
+    return payees
+
+def pick_fixed_amount(v: float, hard_expire_at: datetime):
+    """Fixed price: returns (payee, amount) or None. Exact price on every payee; paise offsets only if opted in."""
+    payees = _shuffled_payees()
+    for pz in range(0, 100 if FIXED_PRICE_PAISE_OFFSETS else 1):
+        amt = round(v + pz / 100.0, 2); key = amount_key(amt)
+        for p in payees:
+            if reserve_amount_key(p["upi_id"], key, hard_expire_at): return p, amt
+    return None
+
+def pick_unique_amount(lo: float, hi: float, hard_expire_at: datetime):
+    """Range price: returns (payee, amount) or None. Whole rupees on every payee are tried before paise offsets."""
     lo, hi = int(lo), int(hi); ints = list(range(lo, hi+1)); random.shuffle(ints)
+    payees = _shuffled_payees()
     for v in ints:
-        if reserve_amount_key(str(v), hard_expire_at): return float(v)
+        for p in payees:
+            if reserve_amount_key(p["upi_id"], str(v), hard_expire_at): return p, float(v)
     for base in ints:
-        for p in range(1,100):
-            key = f"{base}.{p:02d}"
-            if reserve_amount_key(key, hard_expire_at): return float(f"{base}.{p:02d}")
-    return float(ints[-1])
+        for pz in range(1,100):
+            key = f"{base}.{pz:02d}"
+            for p in payees:
+                if reserve_amount_key(p["upi_id"], key, hard_expire_at): return p, float(key)
+    return None
 
 def _normalize_digits(s: str) -> str:
     out=[]
@@ -225,9 +547,40 @@ def _delete_unpaid_qr(context: CallbackContext):
         try: context.bot.delete_message(chat_id=data["chat_id"], message_id=data["qr_message_id"])
         except Exception: pass
 
+def expire_sessions(context: CallbackContext):
+    """
+    Periodic sweep (also runs right after startup): claims every session past hard_expire_at,
+    so active_sessions is decremented exactly once per session even across restarts.
+    """
+    now = datetime.utcnow()
+    for _ in range(500):
+        s = c_sessions.find_one_and_delete({"hard_expire_at": {"$lt": now}})
+        if not s: break
+        bump({"active_sessions": -1, "expired": 1})
+        # keep it matchable for the reconciler in case the payment shows up late
+        s["expired_at"] = now
+        try: c_expired.insert_one(s)
+        except Exception as e: log.error(f"Expired session archive failed: {e}")
+
+def _track_session(item_id: str):
+    bump({"checkouts": 1, "active_sessions": 1, f"products.{item_id}.checkouts": 1})
+
+SLOTS_BUSY_TEXT = "⏳ All payment slots for this item are busy. Please try again in a few minutes."
+
 def start_purchase(ctx: CallbackContext, chat_id: int, uid: int, item_id: str, ref_admin_id: int = None):
     prod = c_products.find_one({"item_id": item_id})
     if not prod: return ctx.bot.send_message(chat_id, "❌ Item not found.")
+    # one open session per (user, item): repeated /start points back at the live QR instead of taking a new slot
+    live = c_sessions.find_one({"user_id": uid, "item_id": item_id, "hard_expire_at": {"$gt": datetime.utcnow()}})
+    if live:
+        left = max(1, int((live["hard_expire_at"] - datetime.utcnow()).total_seconds() // 60))
+        return ctx.bot.send_message(
+            chat_id,
+            f"⏳ You already have a pending payment for this item.\n"
+            f"Pay exactly ₹{fmt_amt(live['amount'])} to `{live.get('payee', UPI_ID)}` (QR above) within {left} min.",
+            parse_mode=ParseMode.MARKDOWN,
+            reply_to_message_id=live.get("qr_message_id"), allow_sending_without_reply=True
+        )
     mn, mx = prod.get("min_price"), prod.get("max_price")
     if mn is None or mx is None:
         v=float(prod.get("price",0))
@@ -242,6 +595,7 @@ def start_purchase(ctx: CallbackContext, chat_id: int, uid: int, item_id: str, r
                     context={"chat_id": chat_id, "message_ids": deliver_ids},
                     name=f"free_del_{uid}_{int(time.time())}"
                 )
+            bump({"free_deliveries": 1, f"products.{item_id}.free": 1})
             # mark order for channels so join-requests auto-approve
             if "channel_id" in prod:
                 try:
@@ -257,14 +611,20 @@ def start_purchase(ctx: CallbackContext, chat_id: int, uid: int, item_id: str, r
 
         created = datetime.utcnow()
         hard_expire_at = created + timedelta(minutes=PAY_WINDOW_MINUTES, seconds=GRACE_SECONDS)
-        amt = v; akey = amount_key(amt)
+        # locks outlive the session by the reconcile tolerance so a late payment can't hit the slot's next owner
+        picked = pick_fixed_amount(v, hard_expire_at + timedelta(minutes=RECONCILE_TOLERANCE_MINUTES))
+        if not picked: return ctx.bot.send_message(chat_id, SLOTS_BUSY_TEXT)
+        payee, amt = picked; akey = amount_key(amt)
 
-        uri = build_upi_uri(amt, f"order_uid_{uid}")
+        uri = build_upi_uri(amt, f"order_uid_{uid}", payee)
         img = qr_url(uri)
         display_amt = int(amt) if abs(amt-int(amt))<1e-9 else f"{amt:.2f}"
+        offset_note = (f"(₹{fmt_amt(v)} + ₹{amt - v:.2f} so your payment can be told apart from other buyers)\n\n"
+                       if abs(amt - v) > 1e-9 else "")
         caption = (
              f"Pay ₹{display_amt} for the item\n\n"
-             f"Upi id - `{UPI_ID}`.\n\n"
+             f"{offset_note}"
+             f"Upi id - `{payee['upi_id']}`.\n\n"
              "Instructions:\n"
              "• Scan this QR or copy the UPI ID\n"
              f"• Pay exactly ₹{display_amt} within {PAY_WINDOW_MINUTES} minutes\n"
@@ -280,11 +640,14 @@ def start_purchase(ctx: CallbackContext, chat_id: int, uid: int, item_id: str, r
             "item_id": item_id,
             "amount": float(amt),
             "amount_key": akey,
+            "payee": payee["upi_id"],
+            "locked": True,
             "created_at": datetime.utcnow(),
-            "hard_expire_at": datetime.utcnow() + timedelta(minutes=PAY_WINDOW_MINUTES, seconds=GRACE_SECONDS),
+            "hard_expire_at": hard_expire_at,
             "qr_message_id": sent.message_id,
             "ref_admin_id": int(ref_admin_id) if ref_admin_id else None,
         })
+        _track_session(item_id)
 
         qr_timeout_mins = int(cfg("qr_unpaid_delete_minutes", PAY_WINDOW_MINUTES))
         ctx.job_queue.run_once(
@@ -298,14 +661,16 @@ def start_purchase(ctx: CallbackContext, chat_id: int, uid: int, item_id: str, r
     # RANGE PRICING path
     created = datetime.utcnow()
     hard_expire_at = created + timedelta(minutes=PAY_WINDOW_MINUTES, seconds=GRACE_SECONDS)
-    amt = pick_unique_amount(mn, mx, datetime.utcnow() + timedelta(minutes=PAY_WINDOW_MINUTES)); akey = amount_key(amt)
+    picked = pick_unique_amount(mn, mx, hard_expire_at + timedelta(minutes=RECONCILE_TOLERANCE_MINUTES))
+    if not picked: return ctx.bot.send_message(chat_id, SLOTS_BUSY_TEXT)
+    payee, amt = picked; akey = amount_key(amt)
 
-    uri = build_upi_uri(amt, f"order_uid_{uid}")
+    uri = build_upi_uri(amt, f"order_uid_{uid}", payee)
     img = qr_url(uri)
     display_amt = int(amt) if abs(amt-int(amt))<1e-9 else f"{amt:.2f}"
     caption = (
          f"Pay ₹{display_amt} for the item\n\n"
-         f"Upi id - `{UPI_ID}`.\n\n"
+         f"Upi id - `{payee['upi_id']}`.\n\n"
          "Instructions:\n"
          "• Scan this QR or copy the UPI ID\n"
          f"• Pay exactly ₹{display_amt} within {PAY_WINDOW_MINUTES} minutes\n"
@@ -321,11 +686,14 @@ def start_purchase(ctx: CallbackContext, chat_id: int, uid: int, item_id: str, r
         "item_id": item_id,
         "amount": float(amt),
         "amount_key": akey,
+        "payee": payee["upi_id"],
+        "locked": True,
         "created_at": datetime.utcnow(),
-        "hard_expire_at": datetime.utcnow() + timedelta(minutes=PAY_WINDOW_MINUTES, seconds=GRACE_SECONDS),
+        "hard_expire_at": hard_expire_at,
         "qr_message_id": sent.message_id,
         "ref_admin_id": int(ref_admin_id) if ref_admin_id else None,
     })
+    _track_session(item_id)
 
     qr_timeout_mins = int(cfg("qr_unpaid_delete_minutes", PAY_WINDOW_MINUTES))
     ctx.job_queue.run_once(
@@ -343,15 +711,32 @@ def deliver(ctx: CallbackContext, uid: int, item_id: str, return_ids: bool = Fal
     """
     prod = c_products.find_one({"item_id": item_id}) or {}
     file_msg_ids=[]
-    # Files
+    # Files — copyMessages takes up to 100 increasing ids from one chat, so a 50-file product is one
+    # rate-limited call instead of 50 (which would hold a pay-lane worker on the per-chat bucket)
     files = prod.get("files") or []
+    runs = []
     for f in files:
-        try:
-            m = ctx.bot.copy_message(chat_id=uid, from_chat_id=f["channel_id"], message_id=f["message_id"],
-                                     protect_content=PROTECT_CONTENT_ENABLED)
-            file_msg_ids.append(m.message_id)
-        except Exception as e:
-            log.warning(f"Copy failed for file {f}: {e}")
+        last = runs[-1] if runs else None
+        if (last and last[0] == f["channel_id"] and last[1][-1] < f["message_id"] and len(last[1]) < 100):
+            last[1].append(f["message_id"])
+        else:
+            runs.append((f["channel_id"], [f["message_id"]]))
+    for ch, mids in runs:
+        if len(mids) > 1:
+            try:
+                res = ctx.bot._post("copyMessages", {"chat_id": uid, "from_chat_id": ch, "message_ids": mids,
+                                                     "protect_content": PROTECT_CONTENT_ENABLED})
+                file_msg_ids.extend(r["message_id"] for r in res)
+                continue
+            except Exception as e:
+                log.warning(f"copyMessages failed, falling back to single copies: {e}")
+        for mid in mids:
+            try:
+                m = ctx.bot.copy_message(chat_id=uid, from_chat_id=ch, message_id=mid,
+                                         protect_content=PROTECT_CONTENT_ENABLED)
+                file_msg_ids.append(m.message_id)
+            except Exception as e:
+                log.warning(f"Copy failed for file {ch}/{mid}: {e}")
 
     # Channel product
     if "channel_id" in prod:
@@ -373,6 +758,125 @@ def deliver(ctx: CallbackContext, uid: int, item_id: str, return_ids: bool = Fal
 
     return file_msg_ids if return_ids else None
 
+# ---- Album-aware ingestion: buffer media-group parts, store them with forwardMessages ----
+_album_lock = threading.Lock()
+
+def forward_bulk(bot, from_chat_id: int, message_ids: list) -> list:
+    """Forward to STORAGE_CHANNEL_ID 100 at a time; per-message fallback if the bulk call fails."""
+    out = []
+    for i in range(0, len(message_ids), 100):
+        chunk = message_ids[i:i+100]
+        try:
+            res = bot._post("forwardMessages", {"chat_id": STORAGE_CHANNEL_ID, "from_chat_id": from_chat_id,
+                                                "message_ids": chunk})
+            out.extend({"channel_id": STORAGE_CHANNEL_ID, "message_id": r["message_id"]} for r in res)
+            continue
+        except Exception as e:
+            log.warning(f"forwardMessages failed, falling back to single forwards: {e}")
+        for mid in chunk:
+            try:
+                fwd = bot.forward_message(STORAGE_CHANNEL_ID, from_chat_id, mid)
+                out.append({"channel_id": fwd.chat_id, "message_id": fwd.message_id})
+            except Exception as e:
+                log.error(f"Store fail for {mid}: {e}")
+    return out
+
+# Storage calls (forwards to STORAGE_CHANNEL_ID, rate-limited at 20/min) run on the "admin" lane so the
+# dispatcher thread — which also logs payment posts — never waits on them. ud['ingest'] identifies the
+# current upload conversation and counts its queued tasks; /cancel drops it so late tasks become no-ops.
+def _ingest_live(ud: dict, ing) -> bool:
+    return ing is not None and ud.get('ingest') is ing
+
+def _ingest_submit(ud: dict, fn, *a):
+    ing = ud.get('ingest')
+    if ing is not None:
+        with _album_lock: ing["pending"] += 1
+    def task():
+        try: fn(*a)
+        finally:
+            if ing is not None:
+                with _album_lock: ing["pending"] -= 1
+    task.__name__ = fn.__name__
+    lane = LANES.get("admin")
+    if lane is None: return task()
+    lane.submit(task)
+
+def ingest_busy(ud: dict) -> bool:
+    ing = ud.get('ingest')
+    with _album_lock:
+        return bool(ing and ing["pending"])
+
+def stash_album_part(update: Update, context: CallbackContext, files_key: str) -> bool:
+    """Buffer a media-group message; returns False for standalone files so callers store them directly."""
+    msg = update.message
+    if not msg.media_group_id: return False
+    ud = context.user_data
+    with _album_lock:
+        batch = ud.get('album_batch')
+        if batch is None:
+            batch = ud['album_batch'] = {"chat_id": msg.chat_id, "files_key": files_key, "ids": [], "job": None,
+                                         "ing": ud.get('ingest')}
+        batch["ids"].append(msg.message_id)
+        if batch["job"]: batch["job"].schedule_removal()
+        batch["job"] = context.job_queue.run_once(
+            _flush_album_job, ALBUM_FLUSH_SECONDS, context=ud, name=f"album_{msg.chat_id}"
+        )
+    return True
+
+def _store_album_batch(bot, ud: dict, batch: dict, announce: bool):
+    ids = sorted(set(batch["ids"]))
+    stored = forward_bulk(bot, batch["chat_id"], ids)
+    with _album_lock:
+        if not _ingest_live(ud, batch["ing"]): return
+        ud.setdefault(batch["files_key"], []).extend(stored)
+    if announce:
+        failed = len(ids) - len(stored)
+        note = f" ({failed} failed)" if failed else ""
+        try: bot.send_message(batch["chat_id"], f"✅ Added {len(stored)} files{note}. Send more or /done.")
+        except Exception as e: log.warning(f"Album ack failed: {e}")
+
+def queue_album_flush(bot, ud: dict, announce: bool = True):
+    """Detach the pending album batch and queue its storage behind everything already queued."""
+    with _album_lock:
+        batch = ud.pop('album_batch', None)
+    if not batch: return
+    if batch["job"]: batch["job"].schedule_removal()
+    _ingest_submit(ud, _store_album_batch, bot, ud, batch, announce)
+
+def _flush_album_job(context: CallbackContext):
+    queue_album_flush(context.bot, context.job.context)
+
+def _store_file(bot, ud: dict, ing, chat_id: int, message_id: int, files_key: str, ok_text: str, fail_text: str):
+    try:
+        fwd = bot.forward_message(STORAGE_CHANNEL_ID, chat_id, message_id)
+    except Exception as e:
+        log.error(f"Store fail: {e}")
+        if _ingest_live(ud, ing):
+            try: bot.send_message(chat_id, fail_text)
+            except Exception: pass
+        return
+    with _album_lock:
+        if not _ingest_live(ud, ing): return
+        ud.setdefault(files_key, []).append({"channel_id": fwd.chat_id, "message_id": fwd.message_id})
+    try: bot.send_message(chat_id, ok_text)
+    except Exception as e: log.warning(f"File ack failed: {e}")
+
+def queue_file_store(update: Update, context: CallbackContext, files_key: str, ok_text: str, fail_text: str):
+    ud = context.user_data
+    # an album sent before this file is queued first, so delivery keeps the upload order
+    queue_album_flush(context.bot, ud)
+    _ingest_submit(ud, _store_file, context.bot, ud, ud.get('ingest'), update.message.chat_id,
+                   update.message.message_id, files_key, ok_text, fail_text)
+
+def _prompt_after_ingest(bot, ud: dict, ing, chat_id: int, files_key: str, text: str, empty_text: str):
+    # runs after every storage task queued before /done, so the file list is complete here
+    if not _ingest_live(ud, ing): return
+    try:
+        if ud.get(files_key): bot.send_message(chat_id, text, parse_mode=ParseMode.MARKDOWN)
+        else: bot.send_message(chat_id, empty_text)
+    except Exception as e:
+        log.warning(f"Prompt send failed: {e}")
+
 GET_PRODUCT_FILES, PRICE = range(2)
 GET_BROADCAST_FILES, GET_BROADCAST_TEXT = range(2)
 
@@ -385,14 +889,12 @@ def start(update: Update, context: CallbackContext):
 def add_product_start(update: Update, context: CallbackContext):
     if not is_admin(update.effective_user.id): return
     context.user_data['new_files']=[]
+    context.user_data['ingest']={"pending": 0}
     if update.message.effective_attachment:
-        try:
-            fwd=context.bot.forward_message(STORAGE_CHANNEL_ID, update.message.chat_id, update.message.message_id)
-            context.user_data['new_files'].append({"channel_id": fwd.chat_id,"message_id": fwd.message_id})
-            update.message.reply_text("✅ First file added. Send more or /done.")
-        except Exception as e:
-            log.error(f"Store fail on first file: {e}")
-            update.message.reply_text("Failed to store first file.")
+        if stash_album_part(update, context, 'new_files'):
+            return GET_PRODUCT_FILES
+        queue_file_store(update, context, 'new_files', "✅ First file added. Send more or /done.",
+                         "Failed to store first file.")
     else:
         update.message.reply_text("Send product files now. Use /done when finished.")
     return GET_PRODUCT_FILES
@@ -401,21 +903,21 @@ def get_product_files(update: Update, context: CallbackContext):
     if not update.message.effective_attachment:
         update.message.reply_text("That wasn’t a file. Send files or /done.")
         return GET_PRODUCT_FILES
-    try:
-        fwd=context.bot.forward_message(STORAGE_CHANNEL_ID, update.message.chat_id, update.message.message_id)
-        context.user_data.setdefault('new_files',[]).append({"channel_id": fwd.chat_id,"message_id": fwd.message_id})
-        update.message.reply_text("✅ Added. Send more or /done.")
-    except Exception as e:
-        log.error(f"Store fail: {e}")
-        update.message.reply_text("Failed to store the file.")
+    if stash_album_part(update, context, 'new_files'):
+        return GET_PRODUCT_FILES
+    queue_file_store(update, context, 'new_files', "✅ Added. Send more or /done.", "Failed to store the file.")
     return GET_PRODUCT_FILES
 
 def finish_adding_files(update: Update, context: CallbackContext):
     if not is_admin(update.effective_user.id): return
-    if not context.user_data.get('new_files'):
+    ud = context.user_data
+    queue_album_flush(context.bot, ud, announce=False)
+    if not ud.get('new_files') and not ingest_busy(ud):
         update.message.reply_text("No files were added. Send a file first.")
         return ConversationHandler.END
-    update.message.reply_text("Send a price like `10` or a range like `10-30`.", parse_mode=ParseMode.MARKDOWN)
+    # the prompt is queued behind the pending stores instead of waiting for them here
+    _ingest_submit(ud, _prompt_after_ingest, context.bot, ud, ud.get('ingest'), update.message.chat_id, 'new_files',
+                   "Send a price like `10` or a range like `10-30`.", "No files could be stored. Use /cancel and try again.")
     return PRICE
 
 def _resolve_channel(context: CallbackContext, text: str) -> int:
@@ -487,7 +989,10 @@ def get_price(update: Update, context: CallbackContext):
     return ConversationHandler.END
 
 def cancel_conv(update: Update, context: CallbackContext):
-    context.user_data.clear()
+    with _album_lock:
+        batch = context.user_data.get('album_batch')
+        if batch and batch["job"]: batch["job"].schedule_removal()
+    context.user_data.clear()  # drops ud['ingest'], so storage tasks still queued do nothing
     update.message.reply_text("Canceled.")
     return ConversationHandler.END
 
@@ -496,6 +1001,7 @@ def bc_start(update: Update, context: CallbackContext):
         return
     context.user_data['b_files'] = []
     context.user_data['b_text'] = None
+    context.user_data['ingest'] = {"pending": 0}
     update.message.reply_text("Send files for broadcast. /done when finished.")
     return GET_BROADCAST_FILES
 
@@ -503,41 +1009,50 @@ def bc_files(update: Update, context: CallbackContext):
     if not update.message.effective_attachment:
         update.message.reply_text("That wasn’t a file. Send files or /done.")
         return GET_BROADCAST_FILES
-    try:
-        fwd=context.bot.forward_message(STORAGE_CHANNEL_ID, update.message.chat_id, update.message.message_id)
-        context.user_data.setdefault('b_files',[]).append({"channel_id": fwd.chat_id,"message_id": fwd.message_id})
-        update.message.reply_text("✅ Added. Send more or /done.")
-    except Exception as e:
-        log.error(f"Store fail: {e}")
-        update.message.reply_text("Failed to store the file.")
+    if stash_album_part(update, context, 'b_files'):
+        return GET_BROADCAST_FILES
+    queue_file_store(update, context, 'b_files', "✅ Added. Send more or /done.", "Failed to store the file.")
     return GET_BROADCAST_FILES
 
 def bc_done(update: Update, context: CallbackContext):
     if not is_admin(update.effective_user.id):
         return ConversationHandler.END
-    if not context.user_data.get('b_files'):
+    ud = context.user_data
+    queue_album_flush(context.bot, ud, announce=False)
+    if not ud.get('b_files') and not ingest_busy(ud):
         update.message.reply_text("No files. Broadcast canceled.")
         return ConversationHandler.END
-    update.message.reply_text("Send the broadcast text (or /cancel to abort).")
+    _ingest_submit(ud, _prompt_after_ingest, context.bot, ud, ud.get('ingest'), update.message.chat_id, 'b_files',
+                   "Send the broadcast text (or /cancel to abort).", "No files could be stored. Use /cancel to abort.")
     return GET_BROADCAST_TEXT
 
-def bc_text(update: Update, context: CallbackContext):
-    if not is_admin(update.effective_user.id):
-        return ConversationHandler.END
-    context.user_data['b_text'] = update.message.text or ""
+def _run_broadcast(bot, admin_chat_id: int, text: str, files: list):
     ids = get_all_user_ids()
     ok=0; fail=0
     for uid in ids:
         try:
-            if context.user_data['b_text']:
-                context.bot.send_message(uid, context.user_data['b_text'])
-            for f in context.user_data.get('b_files', []):
-                context.bot.copy_message(chat_id=uid, from_chat_id=f["channel_id"], message_id=f["message_id"],
-                                         protect_content=PROTECT_CONTENT_ENABLED)
+            if text:
+                bot.send_message(uid, text)
+            for f in files:
+                bot.copy_message(chat_id=uid, from_chat_id=f["channel_id"], message_id=f["message_id"],
+                                 protect_content=PROTECT_CONTENT_ENABLED)
             ok += 1
         except Exception as e:
             fail += 1
-    update.message.reply_text(f"Broadcast sent to {ok} users ({fail} failed).")
+    bot.send_message(admin_chat_id, f"Broadcast sent to {ok} users ({fail} failed).")
+
+def bc_text(update: Update, context: CallbackContext):
+    if not is_admin(update.effective_user.id):
+        return ConversationHandler.END
+    text = update.message.text or ""
+    files = list(context.user_data.get('b_files', []))
+    # conversation callbacks must return a state, so only the send loop moves to the bulk lane
+    lane = LANES.get("bulk")
+    if lane is None:
+        _run_broadcast(context.bot, update.message.chat_id, text, files)
+    else:
+        lane.submit(_run_broadcast, context.bot, update.message.chat_id, text, files)
+        update.message.reply_text("Broadcast queued.")
     context.user_data.clear()
     return ConversationHandler.END
 
@@ -559,9 +1074,169 @@ def set_qr_timeout(update: Update, context: CallbackContext):
     set_cfg("qr_unpaid_delete_minutes", mins)
     update.message.reply_text(f"Set to {mins} minutes.")
 
+# ---- Payment log: hot collection + daily rollups + compressed archive ----
+def log_payment(payee: str, akey: str, amt: float, ts: datetime, text: str):
+    pay_id = None
+    try:
+        pay_id = c_paylog.insert_one({"key": akey, "payee": payee, "amount": float(amt), "ts": ts,
+                                      "inserted_at": datetime.utcnow(), "matched": False,
+                                      "raw": text[:500]}).inserted_id
+    except Exception as e:
+        log.error(f"Paylog insert failed: {e}")
+    try:
+        c_paystats.update_one({"day": ist_day(ts)},
+                              {"$inc": {"notifications": 1, "amount_received": float(amt)}}, upsert=True)
+    except Exception as e:
+        log.error(f"Paystats update failed: {e}")
+    return pay_id
+
+def mark_payment_matched(pay_id, amt: float, ts: datetime):
+    try:
+        if pay_id is not None:
+            c_paylog.update_one({"_id": pay_id}, {"$set": {"matched": True}})
+        c_paystats.update_one({"day": ist_day(ts)},
+                              {"$inc": {"matched": 1, "amount_matched": float(amt)}}, upsert=True)
+    except Exception as e:
+        log.error(f"Paylog match update failed: {e}")
+
+def _paylog_row(d) -> dict:
+    return {"id": str(d["_id"]), "key": d.get("key"), "payee": d.get("payee"), "amount": d.get("amount"),
+            "ts": d["ts"].isoformat(), "matched": d.get("matched"), "raw": d.get("raw", "")}
+
+def archive_paylog(context: CallbackContext):
+    """
+    Move notifications older than PAYLOG_HOT_DAYS out of c_paylog:
+      - one zlib-compressed JSONL doc per IST day and run in c_payarch, upserted on (day, first _id)
+        so a rerun after a failed delete rewrites the same doc instead of duplicating it
+      - optional plain JSONL copy under PAYLOG_EXPORT_DIR (best-effort)
+    """
+    cutoff = datetime.utcnow() - timedelta(days=PAYLOG_HOT_DAYS)
+    deadline = time.monotonic() + PAYLOG_ARCHIVE_BUDGET_SECONDS
+    total = 0
+    while time.monotonic() < deadline:
+        n = _archive_paylog_batch(cutoff)
+        total += n
+        if n < PAYLOG_ARCHIVE_BATCH:
+            break
+    if total:
+        log.info(f"Archived {total} payment log entries")
+
+def _archive_paylog_batch(cutoff: datetime) -> int:
+    """Archive one batch; returns how many rows were moved out of c_paylog."""
+    docs = list(c_paylog.find({"ts": {"$lt": cutoff}}).sort("ts", ASCENDING).limit(PAYLOG_ARCHIVE_BATCH))
+    moved = 0
+    by_day = {}
+    for d in docs:
+        by_day.setdefault(ist_day(d["ts"]), []).append(d)
+    for day, rows in by_day.items():
+        lines = "\n".join(json.dumps(_paylog_row(d), ensure_ascii=False) for d in rows) + "\n"
+        try:
+            c_payarch.update_one(
+                {"day": day, "first_id": rows[0]["_id"]},
+                {"$set": {"count": len(rows), "first_ts": rows[0]["ts"], "last_ts": rows[-1]["ts"],
+                          "data": zlib.compress(lines.encode("utf-8"), 9), "archived_at": datetime.utcnow()}},
+                upsert=True
+            )
+        except Exception as e:
+            log.error(f"Paylog archive failed for {day}: {e}")
+            continue
+        try:
+            moved += c_paylog.delete_many({"_id": {"$in": [d["_id"] for d in rows]}}).deleted_count
+        except Exception as e:
+            log.error(f"Paylog delete after archive failed for {day}: {e}")
+        if PAYLOG_EXPORT_DIR:
+            try:
+                os.makedirs(PAYLOG_EXPORT_DIR, exist_ok=True)
+                with open(os.path.join(PAYLOG_EXPORT_DIR, f"payments-{day}.jsonl"), "a", encoding="utf-8") as fh:
+                    fh.write(lines)
+            except Exception as e:
+                log.warning(f"Paylog JSONL export failed for {day}: {e}")
+    # fewer than a full batch (caught up, or a day failed and would be re-read) ends the run
+    return moved
+
+def paystats(update: Update, context: CallbackContext):
+    if not is_admin(update.effective_user.id): return
+    try:
+        days = max(1, min(int(context.args[0]), 60)) if context.args else 7
+    except Exception:
+        return update.message.reply_text("Usage: /paystats [days]")
+    rows = list(c_paystats.find({}).sort("day", -1).limit(days))
+    if not rows:
+        return update.message.reply_text("No payments logged yet.")
+    lines = [
+        f"{r['day']}: {r.get('matched', 0)}/{r.get('notifications', 0)} matched, "
+        f"₹{fmt_amt(r.get('amount_matched', 0.0))} of ₹{fmt_amt(r.get('amount_received', 0.0))}"
+        for r in rows
+    ]
+    update.message.reply_text("📒 Payments (IST days)\n" + "\n".join(lines))
+
+def fulfil_session(context: CallbackContext, s: dict, ts: datetime):
+    """Deliver a paid session whose doc has already been claimed (removed) by the caller."""
+    qr_mid = s.get("qr_message_id")
+    if qr_mid:
+        try:
+            context.bot.delete_message(chat_id=s["chat_id"], message_id=qr_mid)
+        except Exception as e:
+            log.debug(f"Delete QR failed: {e}")
+
+    try:
+        confirm_msg = context.bot.send_message(s["chat_id"], "✅ Payment received. Delivering your item…")
+        confirm_msg_id = confirm_msg.message_id
+    except Exception as e:
+        log.warning(f"Notify user fail: {e}")
+        confirm_msg_id = None
+
+    ids_to_delete = []
+    if confirm_msg_id:
+        ids_to_delete.append(confirm_msg_id)
+
+    deliver_ids = deliver(context, s["user_id"], s["item_id"], return_ids=True)
+    # Record attributed sale if session had a referring admin
+    try:
+        ref_admin = s.get("ref_admin_id")
+        if ref_admin:
+            c_sales.insert_one({
+                "admin_id": int(ref_admin),
+                "user_id": s["user_id"],
+                "item_id": s["item_id"],
+                "amount": float(s.get("amount", 0.0)),
+                "ts": ts,
+            })
+    except Exception as e:
+        log.error(f"Sales insert failed: {e}")
+    ids_to_delete.extend(deliver_ids or [])
+
+    prod = c_products.find_one({"item_id": s["item_id"]}) or {}
+    if "channel_id" in prod:
+        try:
+            c_orders.update_one(
+                {"user_id": s["user_id"], "channel_id": int(prod["channel_id"])},
+                {"$set": {"item_id": s["item_id"], "paid_at": ts, "status": "paid"}},
+                upsert=True
+            )
+        except Exception as e:
+            log.error(f"Order upsert failed: {e}")
+
+    if ids_to_delete:
+        context.job_queue.run_once(
+            _auto_delete_messages,
+            timedelta(minutes=DELETE_AFTER_MINUTES),
+            context={"chat_id": s["chat_id"], "message_ids": ids_to_delete},
+            name=f"del_{s['user_id']}_{int(time.time())}"
+        )
+
+    paid = float(s.get("amount", 0.0))
+    bump({"payments_matched": 1, "revenue": paid,
+          f"products.{s['item_id']}.paid": 1, f"products.{s['item_id']}.revenue": paid})
+
 def on_channel_post(update: Update, context: CallbackContext):
+    """
+    Runs on the dispatcher thread up to log_payment, so every notification is persisted before
+    matching/delivery is queued on the "pay" lane; if that queue is lost, the reconciler still sees it.
+    """
     msg = update.channel_post
-    if not msg or msg.chat_id != PAYMENT_NOTIF_CHANNEL_ID:
+    payee = PAYEE_BY_CHANNEL.get(msg.chat_id) if msg else None
+    if not payee:
         return
     text = msg.text or msg.caption or ""
     low = text.lower()
@@ -573,70 +1248,99 @@ def on_channel_post(update: Update, context: CallbackContext):
 
     ts = (msg.date or datetime.utcnow()).replace(tzinfo=None)
     akey = amount_key(amt)
-    try:
-        c_paylog.insert_one({"key": akey, "ts": ts, "raw": text[:500]})
-    except:
-        pass
-
-    matches = list(c_sessions.find({"amount_key": akey, "created_at": {"$lte": ts}, "hard_expire_at": {"$gte": ts}}))
-    for s in matches:
-        qr_mid = s.get("qr_message_id")
-        if qr_mid:
-            try:
-                context.bot.delete_message(chat_id=s["chat_id"], message_id=qr_mid)
-            except Exception as e:
-                log.debug(f"Delete QR failed: {e}")
-
-        try:
-            confirm_msg = context.bot.send_message(s["chat_id"], "✅ Payment received. Delivering your item…")
-            confirm_msg_id = confirm_msg.message_id
-        except Exception as e:
-            log.warning(f"Notify user fail: {e}")
-            confirm_msg_id = None
-
-        ids_to_delete = []
-        if confirm_msg_id:
-            ids_to_delete.append(confirm_msg_id)
-
-        deliver_ids = deliver(context, s["user_id"], s["item_id"], return_ids=True)
-        # Record attributed sale if session had a referring admin
-        try:
-            ref_admin = s.get("ref_admin_id")
-            if ref_admin:
-                c_sales.insert_one({
-                    "admin_id": int(ref_admin),
-                    "user_id": s["user_id"],
-                    "item_id": s["item_id"],
-                    "amount": float(s.get("amount", 0.0)),
-                    "ts": ts,
-                })
-        except Exception as e:
-            log.error(f"Sales insert failed: {e}")
-        ids_to_delete.extend(deliver_ids or [])
+    pay_id = log_payment(payee["upi_id"], akey, amt, ts, text)
+    lane = LANES.get("pay")
+    if lane is None:
+        return match_payment(context, payee, akey, amt, ts, pay_id)
+    lane.submit(match_payment, context, payee, akey, amt, ts, pay_id)
+
+def match_payment(context: CallbackContext, payee: dict, akey: str, amt: float, ts: datetime, pay_id):
+    matches = list(c_sessions.find({"payee": payee["upi_id"], "amount_key": akey, "created_at": {"$lte": ts}, "hard_expire_at": {"$gte": ts}}))
+    # claim first so the expiry sweep / reconciler can't deliver the same session twice,
+    # and mark the payment matched before the (slow) delivery so the reconciler skips it
+    claimed = [s for s in matches if c_sessions.find_one_and_delete({"_id": s["_id"]})]
+    if not claimed:
+        return
+    bump({"active_sessions": -len(claimed)})
+    mark_payment_matched(pay_id, amt, ts)
+    for s in claimed:
+        fulfil_session(context, s, ts)
+        if s.get("locked"): release_amount_key(payee["upi_id"], akey)
+
+# ---- Reconciler: late / early payments that on_channel_post couldn't match ----
+def _notify_admins(bot, text: str):
+    for aid in get_admin_ids():
+        try: bot.send_message(aid, text)
+        except Exception as e: log.debug(f"Admin notify failed ({aid}): {e}")
+
+def _claim_candidate(s: dict) -> bool:
+    if s.get("expired_at"):
+        return bool(c_expired.find_one_and_delete({"_id": s["_id"]}))
+    if c_sessions.find_one_and_delete({"_id": s["_id"]}):
+        bump({"active_sessions": -1})
+        if s.get("locked"): release_amount_key(s.get("payee"), s["amount_key"])
+        return True
+    return False
 
-        prod = c_products.find_one({"item_id": s["item_id"]}) or {}
-        if "channel_id" in prod:
-            try:
-                c_orders.update_one(
-                    {"user_id": s["user_id"], "channel_id": int(prod["channel_id"])},
-                    {"$set": {"item_id": s["item_id"], "paid_at": ts, "status": "paid"}},
-                    upsert=True
-                )
-            except Exception as e:
-                log.error(f"Order upsert failed: {e}")
-
-        if ids_to_delete:
-            context.job_queue.run_once(
-                _auto_delete_messages,
-                timedelta(minutes=DELETE_AFTER_MINUTES),
-                context={"chat_id": s["chat_id"], "message_ids": ids_to_delete},
-                name=f"del_{s['user_id']}_{int(time.time())}"
-            )
+def reconcile_payments(context: CallbackContext):
+    """
+    Walk unmatched paylog entries inserted after the stored checkpoint (index: matched, inserted_at;
+    insert time, not msg.date, so posts that sat in a lane queue aren't skipped) and look for
+    live or recently expired sessions with the same payee + amount_key within the tolerance window.
+      - exactly one candidate and auto-deliver on: deliver it
+      - otherwise (none or several): flag the payment to admins
+    """
+    now = datetime.utcnow()
+    tol = timedelta(minutes=RECONCILE_TOLERANCE_MINUTES)
+    ckpt = cfg("reconcile_inserted_checkpoint") or (now - tol)
+    upto = now - timedelta(seconds=RECONCILE_SETTLE_SECONDS)
+    auto = bool(cfg("reconcile_auto_deliver", True))
+    pays = list(c_paylog.find({"matched": False, "flagged": {"$ne": True},
+                               "inserted_at": {"$gte": ckpt, "$lte": upto}})
+                .sort("inserted_at", ASCENDING).limit(500))
+    for p in pays:
+        ckpt = p["inserted_at"]
+        ts = p["ts"]
+        q = {"payee": p.get("payee"), "amount_key": p["key"],
+             "created_at": {"$lte": ts + tol}, "hard_expire_at": {"$gte": ts - tol}}
+        cands = list(c_sessions.find(q)) + list(c_expired.find(q))
+        s = None
+        if len(cands) == 1 and auto:
+            s = cands[0] if _claim_candidate(cands[0]) else None
+            if s is None:
+                # lost the claim to match_payment or the expiry sweep: re-check before alerting anyone
+                if (c_paylog.find_one({"_id": p["_id"]}, {"matched": 1}) or {}).get("matched"):
+                    continue
+                cands = list(c_sessions.find(q)) + list(c_expired.find(q))
+                if len(cands) == 1 and _claim_candidate(cands[0]):
+                    s = cands[0]
+        if s:
+            fulfil_session(context, s, ts)
+            mark_payment_matched(p["_id"], p.get("amount", s.get("amount", 0.0)), ts)
+            c_paylog.update_one({"_id": p["_id"]}, {"$set": {"reconciled": True}})
+            _notify_admins(context.bot, f"🔁 Late payment ₹{p['key']} ({p.get('payee')}) auto-delivered "
+                                        f"to {s['user_id']} for {s['item_id']}.")
+        elif cands:
+            c_paylog.update_one({"_id": p["_id"]}, {"$set": {"flagged": True}})
+            lines = [f"• user {s['user_id']} · {s['item_id']} · {s['created_at']:%H:%M:%S} UTC" for s in cands[:10]]
+            _notify_admins(context.bot, f"⚠️ Unmatched payment ₹{p['key']} ({p.get('payee')}) at {ts:%H:%M:%S} UTC "
+                                        f"has {len(cands)} possible sessions:\n" + "\n".join(lines))
+        else:
+            c_paylog.update_one({"_id": p["_id"]}, {"$set": {"flagged": True}})
+            _notify_admins(context.bot, f"⚠️ Payment ₹{p['key']} ({p.get('payee')}) at {ts:%H:%M:%S} UTC "
+                                        f"matches no session.")
+    # a full batch resumes from its last insert time; otherwise everything up to `upto` has been seen
+    set_cfg("reconcile_inserted_checkpoint", ckpt if len(pays) == 500 else upto)
 
-        c_sessions.delete_one({"_id": s["_id"]})
-        release_amount_key(akey)
+def reconcile_auto(update: Update, context: CallbackContext):
+    if not is_admin(update.effective_user.id): return
+    if context.args and context.args[0].lower() in ("on", "off"):
+        set_cfg("reconcile_auto_deliver", context.args[0].lower() == "on")
+    state = "ON" if cfg("reconcile_auto_deliver", True) else "OFF (flag to admins only)"
+    update.message.reply_text(f"Late-payment auto-delivery: {state}")
 
 # ---- Auto-approve join-requests for paid buyers ----
+@in_lane("pay")
 def on_join_request(update: Update, context: CallbackContext):
     req = update.chat_join_request
     if not req:
@@ -652,9 +1356,29 @@ def on_join_request(update: Update, context: CallbackContext):
 
 def stats(update, context):
     if not is_admin(update.effective_user.id): return
-    users = c_users.count_documents({})
-    sessions = c_sessions.count_documents({})
-    update.message.reply_text(f"Users: {users}\nPending sessions: {sessions}")
+    c = c_counters.find_one({"_id": COUNTERS_ID})
+    if not c:
+        users = c_users.estimated_document_count()
+        sessions = c_sessions.estimated_document_count()
+        return update.message.reply_text(f"Users: ~{users}\nPending sessions: ~{sessions}")
+    checkouts = int(c.get("checkouts", 0)); paid = int(c.get("payments_matched", 0))
+    conv = f"{paid * 100.0 / checkouts:.1f}%" if checkouts else "—"
+    lines = [
+        f"Users: {int(c.get('users', 0))}",
+        f"Pending sessions: {max(0, int(c.get('active_sessions', 0)))}",
+        f"Checkouts: {checkouts}",
+        f"Payments matched: {paid}",
+        f"Conversion: {conv}",
+        f"Revenue: ₹{fmt_amt(float(c.get('revenue', 0.0)))}",
+    ]
+    prods = sorted((c.get("products") or {}).items(), key=lambda kv: kv[1].get("revenue", 0.0), reverse=True)[:10]
+    if prods:
+        lines.append("\nTop products:")
+        for item_id, p in prods:
+            pc = int(p.get("checkouts", 0)); pp = int(p.get("paid", 0))
+            pconv = f"{pp * 100.0 / pc:.0f}%" if pc else "—"
+            lines.append(f"{item_id}: ₹{fmt_amt(float(p.get('revenue', 0.0)))} ({pp}/{pc}, {pconv})")
+    update.message.reply_text("\n".join(lines))
 
 def protect_on(update, context):
     if not is_admin(update.effective_user.id): return
@@ -667,6 +1391,7 @@ def protect_off(update, context):
     PROTECT_CONTENT_ENABLED = False
     update.message.reply_text("Content protection OFF.")
 
+@in_lane("user")
 def cmd_start(update: Update, context: CallbackContext):
     uid = update.effective_user.id
     add_user(uid, update.effective_user.username)
@@ -740,6 +1465,17 @@ def rmadmin(update: Update, context: CallbackContext):
     set_admin_ids(ids_no_owner)
     update.message.reply_text(f"✅ Removed admin {rem_id}.")
 
+def lanes(update: Update, context: CallbackContext):
+    if not is_admin(update.effective_user.id): return
+    if not LANES:
+        return update.message.reply_text("Lanes not running.")
+    update.message.reply_text("🚦 Lanes\n" + "\n".join(l.stats() for l in LANES.values()))
+
+def apistats(update: Update, context: CallbackContext):
+    if not is_admin(update.effective_user.id): return
+    m = getattr(context.bot, "metrics_text", None)
+    update.message.reply_text("📡 Bot API\n" + (m() if m else "Metrics unavailable."))
+
 def admins(update: Update, context: CallbackContext):
     uid = update.effective_user.id
     if not is_owner(uid):
@@ -752,10 +1488,13 @@ def main():
     set_cfg("force_sub_text", cfg("force_sub_text", "Join required channels to continue."))
     if cfg("qr_unpaid_delete_minutes") is None:
         set_cfg("qr_unpaid_delete_minutes", PAY_WINDOW_MINUTES)
+    seed_counters()
+    start_lanes()
 
-    os.system(f'curl -s "https://api.telegram.org/bot{TOKEN}/deleteWebhook" >/dev/null')
+    bot = OutboundBot(TOKEN, request=Request(con_pool_size=API_POOL_SIZE, connect_timeout=10.0, read_timeout=30.0))
+    bot.delete_webhook()
 
-    updater = Updater(TOKEN, use_context=True)
+    updater = Updater(bot=bot, use_context=True)
     dp = updater.dispatcher
 
     # Files product flow
@@ -778,11 +1517,24 @@ def main():
         persistent=False
     )
 
+    # Broadcast flow — registered before add_conv so files sent after /broadcast go to the broadcast
+    bc_conv = ConversationHandler(
+        entry_points=[CommandHandler("broadcast", bc_start)],
+        states={
+            GET_BROADCAST_FILES: [MessageHandler((Filters.document | Filters.video | Filters.photo) & ~Filters.command, bc_files),
+                                  CommandHandler('done', bc_done)],
+            GET_BROADCAST_TEXT: [MessageHandler(Filters.text & ~Filters.command, bc_text)]
+        },
+        fallbacks=[CommandHandler('cancel', cancel_conv)],
+        name="bc_conv",
+        persistent=False
+    )
+
+    dp.add_handler(bc_conv, group=0)
     dp.add_handler(add_conv, group=0)
     dp.add_handler(add_channel_conv, group=0)
 
-    # Broadcast & misc (self-guarded)
-    dp.add_handler(CommandHandler("broadcast", bc_start))
+    # Misc (self-guarded)
     dp.add_handler(CommandHandler("start", cmd_start))
     dp.add_handler(CommandHandler("stats", stats))
     dp.add_handler(CommandHandler("qr_timeout", qr_timeout_show))
@@ -790,17 +1542,27 @@ def main():
     dp.add_handler(CommandHandler("protect_on", protect_on))
     dp.add_handler(CommandHandler("protect_off", protect_off))
     dp.add_handler(CommandHandler("earning", earning))
+    dp.add_handler(CommandHandler("paystats", paystats))
+    dp.add_handler(CommandHandler("reconcile_auto", reconcile_auto))
     dp.add_handler(CommandHandler("addadmin", addadmin))
     dp.add_handler(CommandHandler("rmadmin", rmadmin))
     dp.add_handler(CommandHandler("admins", admins))
+    dp.add_handler(CommandHandler("lanes", lanes))
+    dp.add_handler(CommandHandler("apistats", apistats))
     dp.add_handler(CallbackQueryHandler(on_cb, pattern="^(check_join)$"))
 
     # Payments + join requests
-    dp.add_handler(MessageHandler(Filters.update.channel_post & Filters.chat(PAYMENT_NOTIF_CHANNEL_ID) & Filters.text, on_channel_post))
+    dp.add_handler(MessageHandler(Filters.update.channel_post & Filters.chat(PAYMENT_NOTIF_CHANNEL_IDS) & Filters.text, on_channel_post))
     dp.add_handler(ChatJoinRequestHandler(on_join_request))
 
+    updater.job_queue.run_repeating(expire_sessions, interval=SESSION_SWEEP_SECONDS, first=0, name="session_expiry")
+    updater.job_queue.run_repeating(reconcile_payments, interval=RECONCILE_INTERVAL_SECONDS, first=30, name="reconcile")
+    updater.job_queue.run_repeating(archive_paylog, interval=3600, first=60, name="paylog_archive")
+
     logging.info("Bot running…"); updater.start_polling(); updater.idle()
+    stop_lanes()
 
+@in_lane("user")
 def on_cb(update: Update, context: CallbackContext):
     if update.callback_query and update.callback_query.data=="check_join":
         check_join(update, context)